@@ -1,7 +1,20 @@
 import argparse
+import functools
+import glob
+import json
 import os
 import platform
+import shlex
+import shutil
+import subprocess
 import sys
+import tarfile
+import tempfile
+import threading
+import time
+import traceback
+import urllib.request
+from concurrent.futures import FIRST_EXCEPTION, ThreadPoolExecutor, wait
 
 from print_env_info import run_and_parse_first_match
 
@@ -10,63 +23,121 @@ sys.path.append(REPO_ROOT)
 
 from ts_scripts.utils import check_python_version
 
+PLATFORM = platform.system()
+PLATFORM_LOWER = PLATFORM.lower()
+
+
+@functools.lru_cache(maxsize=None)
+def _which(name):
+    return shutil.which(name)
+
+
+@functools.lru_cache(maxsize=None)
+def _uv():
+    """Returns the path to uv if it was requested with --use_uv, else None."""
+
+    return _which("uv") if args.use_uv else None
+
+
+def _pip_install(*args):
+    """Runs `pip install` for the interpreter running this script, using uv if requested."""
+
+    if _uv():
+        # unsafe-best-match keeps pip's behaviour of picking the best version
+        # across PyPI and the extra torch index rather than the first index
+        installer = [_uv(), "pip", "install", "--python", sys.executable]
+        installer += ["--index-strategy", "unsafe-best-match"]
+    else:
+        installer = [sys.executable, "-m", "pip", "install"]
+
+    # close_fds=False together with an absolute executable path lets
+    # subprocess use posix_spawn instead of fork+exec; python opens its file
+    # descriptors as non-inheritable so none leak
+    subprocess.check_call([*installer, *args], close_fds=False)
+
+
+def _download(url):
+    """Downloads `url` to a temporary file and returns its path."""
+
+    with urllib.request.urlopen(url) as r, tempfile.NamedTemporaryFile(
+        delete=False
+    ) as f:
+        shutil.copyfileobj(r, f)
+    return f.name
+
 
 class Common:
     def __init__(self):
-        self.torch_stable_url = "https://download.pytorch.org/whl/torch_stable.html"
         self.sudo_cmd = "sudo "
 
+    def check_prerequisites(self):
+        pass
+
     def install_java(self):
         pass
 
     def install_nodejs(self):
         pass
 
-    def install_torch_packages(self, cuda_version):
-        if cuda_version:
-            if platform.system() == "Darwin":
-                print(
-                    "CUDA not supported on MacOS. Refer https://pytorch.org/ for installing from source."
-                )
-                sys.exit(1)
-            elif cuda_version == "cu92" and platform.system() == "Windows":
-                print(
-                    "CUDA 9.2 not supported on Windows. Refer https://pytorch.org/ for installing from source."
-                )
-                sys.exit(1)
-            else:
-                os.system(
-                    f"{sys.executable} -m pip install -U -r requirements/torch_{cuda_version}_{platform.system().lower()}.txt"
-                )
-        else:
-            os.system(
-                f"{sys.executable} -m pip install -U -r requirements/torch_{platform.system().lower()}.txt"
-            )
-
-    def install_python_packages(self, cuda_version, requirements_file_path, nightly):
-        check = "where" if platform.system() == "Windows" else "which"
-        if os.system(f"{check} conda") == 0:
+    def install_python_packages(
+        self,
+        cuda_version,
+        torch_requirements_file_path,
+        requirements_file_path,
+        nightly,
+    ):
+        if _which("conda"):
             # conda install command should run before the pip install commands
-            # as it may reinstall the packages with different versions
-            os.system("conda install -y conda-build")
+            # as it may reinstall the packages with different versions.
+            # Prefer mamba when available as its solver is much faster.
+            conda_cmd = "mamba" if _which("mamba") else "conda"
+            os.system(f"{conda_cmd} install -y conda-build")
+
+        # Upgrade pip before the heavy install so that the torch stack is
+        # resolved and downloaded by the faster pip>=24.2. Not needed when
+        # uv does the installs.
+        if _uv():
+            _pip_install("-U", "setuptools")
+        else:
+            _pip_install("-U", "pip>=24.2", "setuptools")
 
-        self.install_torch_packages(cuda_version)
-        os.system(f"{sys.executable} -m pip install -U pip setuptools")
-        # developer.txt also installs packages from common.txt
-        os.system(f"{sys.executable} -m pip install -U -r {requirements_file_path}")
-        # If conda is available install conda-build package
+        # Install torch and developer.txt (which also installs packages from
+        # common.txt) with a single pip invocation so that the requirements
+        # are resolved and downloaded in one pass
+        _pip_install(
+            "-U", "-r", torch_requirements_file_path, "-r", requirements_file_path
+        )
 
         # TODO: This will run 2 installations for torch but to make this cleaner we should first refactor all of our requirements.txt into just 2 files
         # And then make torch an optional dependency for the common.txt
         if nightly:
-            os.system(
-                f"pip3 install numpy --pre torch[dynamo] torchvision torchtext torchaudio --force-reinstall --extra-index-url https://download.pytorch.org/whl/nightly/{cuda_version}"
+            _pip_install(
+                "numpy",
+                "--pre",
+                "torch[dynamo]",
+                "torchvision",
+                "torchtext",
+                "torchaudio",
+                "--force-reinstall",
+                "--extra-index-url",
+                f"https://download.pytorch.org/whl/nightly/{cuda_version}",
             )
 
     def install_node_packages(self):
-        os.system(
-            f"{self.sudo_cmd}npm install -g newman newman-reporter-htmlextra markdown-link-check"
+        packages = ["newman", "newman-reporter-htmlextra", "markdown-link-check"]
+
+        # Only install the packages which aren't already installed globally
+        result = subprocess.run(
+            "npm ls -g --depth=0 --json", shell=True, capture_output=True, text=True
         )
+        try:
+            installed = json.loads(result.stdout or "{}").get("dependencies", {})
+        except ValueError:
+            installed = {}
+        missing = [package for package in packages if package not in installed]
+
+        if missing:
+            os.system(f"{self.sudo_cmd}npm install -g {' '.join(missing)}")
 
     def install_jmeter(self):
         pass
@@ -74,6 +145,9 @@ class Common:
     def install_wget(self):
         pass
 
+    def flush_apt(self):
+        pass
+
 
 class Linux(Common):
     def __init__(self):
@@ -81,31 +155,103 @@ class Linux(Common):
         # Skip 'sudo ' when the user is root
         self.sudo_cmd = "" if os.geteuid() == 0 else self.sudo_cmd
 
-        if args.force:
-            os.system(f"{self.sudo_cmd}apt-get update")
+        # Keep downloaded .deb packages in APT_CACHE_DIR, when set, so that
+        # they can be reused across runs (e.g. a persistent CI cache volume)
+        self.apt_cmd = f"{self.sudo_cmd}apt-get"
+        self._apt_pending = []
+        apt_cache_dir = os.environ.get("APT_CACHE_DIR")
+        if apt_cache_dir:
+            partial_dir = shlex.quote(os.path.join(apt_cache_dir, "partial"))
+            os.system(f"{self.sudo_cmd}mkdir -p {partial_dir}")
+            self.apt_cmd += f" -o Dir::Cache::archives={shlex.quote(apt_cache_dir)}"
+
+        # Download the NodeSource setup script in the background so that it
+        # overlaps with the apt-get update below. The script only adds the
+        # NodeSource apt repository, so skip it if that is already set up
+        # for node 14.
+        self._downloads = None
+        self._nodesource_setup = None
+        if (
+            args.environment == "dev"
+            and (not _which("node") or args.force)
+            and not self.has_nodesource_14_repo()
+        ):
+            self._downloads = ThreadPoolExecutor(max_workers=1)
+            self._nodesource_setup = self._downloads.submit(
+                _download, "https://deb.nodesource.com/setup_14.x"
+            )
+
+        if args.force and not self.is_apt_lists_fresh():
+            os.system(f"{self.apt_cmd} -o Acquire::Languages=none update")
+
+    def check_prerequisites(self):
+        # In dev, libgit2's `make install` needs sudo while the system
+        # packages are installed concurrently, so ask for the password once
+        # up front rather than from both at the same time
+        if self.sudo_cmd and args.environment == "dev":
+            os.system("sudo -v")
+
+    def has_nodesource_14_repo(self):
+        """Returns True if the NodeSource apt repository for node 14 is configured."""
+
+        try:
+            with open("/etc/apt/sources.list.d/nodesource.list") as f:
+                return "node_14.x" in f.read()
+        except OSError:
+            return False
+
+    def is_apt_lists_fresh(self, max_age=60 * 60):
+        """Returns True if the apt package lists were updated in the last `max_age` seconds."""
+
+        # Use the index files rather than the directory itself, whose mtime
+        # also changes when the lists are deleted (e.g. in Docker images)
+        index_files = glob.glob("/var/lib/apt/lists/*_Packages*")
+        index_files += glob.glob("/var/lib/apt/lists/*InRelease")
+        if not index_files:
+            return False
+        return time.time() - max(map(os.path.getmtime, index_files)) < max_age
 
     def install_java(self):
-        if os.system("javac --version") != 0 or args.force:
-            os.system(f"{self.sudo_cmd}apt-get install -y openjdk-17-jdk")
+        if not _which("javac") or args.force:
+            self._apt_pending.append("openjdk-17-jdk")
 
     def install_nodejs(self):
-        if os.system("node -v") != 0 or args.force:
-            os.system(
-                f"{self.sudo_cmd}curl -sL https://deb.nodesource.com/setup_14.x | {self.sudo_cmd}bash -"
-            )
-            os.system(f"{self.sudo_cmd}apt-get install -y nodejs")
+        if not _which("node") or args.force:
+            if self._nodesource_setup:
+                setup_script = self._nodesource_setup.result()
+                self._downloads.shutdown()
+                os.system(f"{self.sudo_cmd}bash {setup_script}")
+                os.remove(setup_script)
+            self._apt_pending.append("nodejs")
 
     def install_wget(self):
-        if os.system("wget --version") != 0 or args.force:
-            os.system(f"{self.sudo_cmd}apt-get install -y wget")
+        if not _which("wget") or args.force:
+            self._apt_pending.append("wget")
+
+    def flush_apt(self):
+        """Installs the apt packages queued by the install_* methods in one transaction."""
+
+        if self._apt_pending:
+            packages = " ".join(self._apt_pending)
+            if os.system(f"{self.apt_cmd} install -y {packages}") != 0:
+                sys.exit(f"**Error: Failed to install apt packages: {packages}")
+            self._apt_pending = []
 
     def install_libgit2(self):
+        # Extract while downloading instead of writing the tarball to disk first
+        with urllib.request.urlopen(
+            "https://github.com/libgit2/libgit2/archive/refs/tags/v1.3.0.tar.gz"
+        ) as r, tarfile.open(fileobj=r, mode="r|gz") as tar:
+            if hasattr(tarfile, "data_filter"):
+                tar.extractall(filter="data")
+            else:
+                tar.extractall()
+        # BUILD_CLAR is libgit2 1.3's switch for building the test suite
         os.system(
-            f"wget https://github.com/libgit2/libgit2/archive/refs/tags/v1.3.0.tar.gz -O libgit2-1.3.0.tar.gz"
+            f"cd libgit2-1.3.0 && cmake -DCMAKE_BUILD_TYPE=Release -DBUILD_CLAR=OFF . "
+            f"&& make -j{os.cpu_count() or 4} && {self.sudo_cmd}make install && cd .."
         )
-        os.system(f"tar xzf libgit2-1.3.0.tar.gz")
-        os.system(f"cd libgit2-1.3.0 && cmake . && make && sudo make install && cd ..")
-        os.system(f"rm -rf libgit2-1.3.0 && rm libgit2-1.3.0.tar.gz")
+        os.system(f"rm -rf libgit2-1.3.0")
 
 
 class Windows(Common):
@@ -126,12 +272,17 @@ class Windows(Common):
 class Darwin(Common):
     def __init__(self):
         super().__init__()
+        self._install_java = os.system("javac -version") != 0 or args.force
 
-    def install_java(self):
-        if os.system("javac -version") != 0 or args.force:
+    def check_prerequisites(self):
+        super().check_prerequisites()
+        if args.environment == "dev" or self._install_java:
             out = get_brew_version()
             if out == "N/A":
                 sys.exit("**Error: Homebrew not installed...")
+
+    def install_java(self):
+        if self._install_java:
             os.system("brew install openjdk@17")
 
     def install_nodejs(self):
@@ -140,31 +291,120 @@ class Darwin(Common):
         os.system("brew link --overwrite node@14")
 
     def install_node_packages(self):
-        os.system(f"{self.sudo_cmd} ./ts_scripts/mac_npm_deps")
+        os.system(f"{self.sudo_cmd}./ts_scripts/mac_npm_deps")
 
     def install_wget(self):
-        if os.system("wget --version") != 0 or args.force:
+        if not _which("wget") or args.force:
             os.system("brew install wget")
 
 
 def install_dependencies(cuda_version=None, nightly=False):
+    requirements_file_path = "requirements/" + (
+        "production.txt" if args.environment == "prod" else "developer.txt"
+    )
+
+    # Fail before anything is downloaded if a requirements file is missing
+    torch_requirements_file_path = get_torch_requirements_file_path(cuda_version)
+    missing = [
+        path
+        for path in (
+            torch_requirements_file_path,
+            requirements_file_path,
+            # included by both developer.txt and production.txt
+            "requirements/common.txt",
+        )
+        if not os.path.exists(path)
+    ]
+    if missing:
+        sys.exit(f"**Error: Requirements file(s) not found: {', '.join(missing)}")
+
+    if args.use_uv and not _which("uv"):
+        sys.exit("**Error: --use_uv was passed but uv is not installed...")
+
     os_map = {"Linux": Linux, "Windows": Windows, "Darwin": Darwin}
-    system = os_map[platform.system()]()
+    system = os_map[PLATFORM]()
 
+    system.check_prerequisites()
+
+    system_steps = []
+    if args.environment == "dev":
+        system_steps += [system.install_wget, system.install_nodejs]
+    system_steps += [system.install_java, system.flush_apt]
+    # npm is only available once nodejs has been installed
     if args.environment == "dev":
-        system.install_wget()
-        system.install_nodejs()
-        system.install_node_packages()
+        system_steps.append(system.install_node_packages)
+
+    python_steps = []
+    if PLATFORM == "Linux" and args.environment == "dev":
+        python_steps.append(system.install_libgit2)
+    python_steps.append(
+        functools.partial(
+            system.install_python_packages,
+            cuda_version,
+            torch_requirements_file_path,
+            requirements_file_path,
+            nightly,
+        )
+    )
+
+    aborted = threading.Event()
+
+    def run_steps(steps):
+        for step in steps:
+            if aborted.is_set():
+                break
+            step()
+
+    # The system and python packages don't depend on each other so install
+    # them concurrently. Sequence of installation within each is maintained.
+    executor = ThreadPoolExecutor(max_workers=2)
+    futures = [
+        executor.submit(run_steps, steps) for steps in (system_steps, python_steps)
+    ]
+    done, not_done = wait(futures, return_when=FIRST_EXCEPTION)
+
+    # On failure, report it right away and let the other lane stop after its
+    # current step instead of waiting for it to finish
+    aborted.set()
+    executor.shutdown(wait=False)
+    for future in done:
+        error = future.exception()
+        if error is None:
+            continue
+        if not not_done:
+            future.result()
+
+        # The other lane's current step (e.g. a pip install or the libgit2
+        # build) can't be interrupted and the process only exits once it is
+        # done, so say so after the error instead of appearing to hang
+        if isinstance(error, SystemExit):
+            if isinstance(error.code, str):
+                print(error.code, file=sys.stderr)
+        else:
+            traceback.print_exception(type(error), error, error.__traceback__)
+        print(
+            "Waiting for the install step running concurrently to finish before exiting...",
+            file=sys.stderr,
+        )
+        sys.exit(1)
 
-    if platform.system() == "Linux" and args.environment == "dev":
-        system.install_libgit2()
 
-    # Sequence of installation to be maintained
-    system.install_java()
-    requirements_file_path = "requirements/" + (
-        "production.txt" if args.environment == "prod" else "developer.txt"
-    )
-    system.install_python_packages(cuda_version, requirements_file_path, nightly)
+def get_torch_requirements_file_path(cuda_version):
+    """Returns the torch requirements file for the given CUDA version."""
+
+    if cuda_version and PLATFORM == "Darwin":
+        print(
+            "CUDA not supported on MacOS. Refer https://pytorch.org/ for installing from source."
+        )
+        sys.exit(1)
+    elif cuda_version == "cu92" and PLATFORM == "Windows":
+        print(
+            "CUDA 9.2 not supported on Windows. Refer https://pytorch.org/ for installing from source."
+        )
+        sys.exit(1)
+
+    cuda_prefix = f"{cuda_version}_" if cuda_version else ""
+    return f"requirements/torch_{cuda_prefix}{PLATFORM_LOWER}.txt"
 
 
 def get_brew_version():
@@ -197,10 +437,18 @@ if __name__ == "__main__":
         help="Install nightly version of torch package",
     )
 
+    parser.add_argument(
+        "--use_uv",
+        action="store_true",
+        help="Install python packages with uv instead of pip. uv ignores pip's "
+        "configuration (pip.conf and PIP_* environment variables)",
+    )
+
     parser.add_argument(
         "--force",
         action="store_true",
-        help="force reinstall dependencies wget, node, java and apt-update",
+        help="force reinstall dependencies wget, node, java and apt-update "
+        "(apt-update is skipped if the package lists are less than an hour old)",
     )
     args = parser.parse_args()
 